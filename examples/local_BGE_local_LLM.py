@@ -3,18 +3,24 @@ from __future__ import annotations
 import os, sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import os, json, time, asyncio, logging, re
+import os, json, time, asyncio, atexit, functools, itertools, logging, operator, queue, re, sqlite3, threading
+import multiprocessing as mp
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import TYPE_CHECKING, List
 
 import numpy as np
-from tqdm import tqdm
-from transformers import AutoTokenizer, AutoModel
-from sentence_transformers import SentenceTransformer, models
+import orjson
+import xxhash
 from openai import AsyncOpenAI
-import aiohttp.client_exceptions
+import httpx
 import torch, gc
+import torch.nn.functional as F
+
+if TYPE_CHECKING:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from sentence_transformers import SentenceTransformer
+    from transformers import PreTrainedTokenizerFast
 
 from graphrag import GraphRAG, QueryParam
 from graphrag.base import BaseKVStorage
@@ -22,7 +28,6 @@ from graphrag._utils import compute_args_hash, logger
 
 from graphrag import GraphRAG, QueryParam
 import json
-from tqdm import tqdm
 from pathlib import Path
 
 WORK_DIR = Path("work_dir")
@@ -31,9 +36,6 @@ CORPUS_FILE = Path("demo/Corpus.json")
 
 from graphrag._utils import compute_args_hash, logger
 
-import tiktoken
-tiktoken.get_encoding("cl100k_base")
-
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("DyG-RAG").setLevel(logging.INFO)
 
@@ -41,10 +43,14 @@ logging.getLogger("DyG-RAG").setLevel(logging.INFO)
 # 0. Configuration
 ################################################################################
 def get_config_value(env_name: str, description: str, example: str = None) -> str:
-    """Get configuration value from environment variable or user input."""
+    """Get configuration value from environment variable or, on a terminal, from user input."""
     value = os.getenv(env_name)
     if value:
         return value
+
+    # Notebooks, CI and worker processes have nobody to answer input(); fail instead of hanging
+    if sys.stdin is None or not sys.stdin.isatty():
+        raise RuntimeError(f"Missing configuration {env_name}: {description}" + (f" (e.g. {example})" if example else ""))
     
     print(f"\n⚠️  Missing configuration: {env_name}")
     print(f"Description: {description}")
@@ -54,96 +60,596 @@ def get_config_value(env_name: str, description: str, example: str = None) -> st
     while True:
         user_input = input(f"Please enter {env_name}: ").strip()
         if user_input:
+            # Export it so processes started later inherit the value instead of asking again
+            os.environ[env_name] = user_input
             return user_input
         print("❌ Value cannot be empty. Please try again.")
 
-print("🔧 Checking configuration...")
-VLLM_BASE_URL = get_config_value(
-    "VLLM_BASE_URL", 
-    "Base URL for VLLM API service", 
-    "http://127.0.0.1:8000/v1"
-)
-
-BEST_MODEL_NAME = get_config_value(
-    "QWEN_BEST", 
-    "Model name for the best/primary LLM", 
-    "qwen-14b"
-)
-
-LOCAL_BGE_PATH = get_config_value(
-    "LOCAL_BGE_PATH", 
-    "Local path to BGE embedding model", 
-    "/path/to/bge-m3"
-)
+@dataclass(frozen=True)
+class ExampleConfig:
+    """Every setting of this example, read from the environment once at import."""
+    vllm_base_url: str
+    best_model_name: str
+    # "local" loads BGE in this process with sentence-transformers, "onnx" runs it with ONNX Runtime,
+    # "tei" calls a text-embeddings-inference server instead
+    bge_backend: str
+    local_bge_path: str | None
+    emb_url: str | None
+    # HF tokenizer of the served Qwen models; when set, prompts are tokenized here and sent to vLLM as token ids
+    vllm_tokenizer_path: str | None
+    # Context length vLLM serves the models with; /v1/completions defaults max_tokens to 16, so the
+    # token-id path asks for whatever room the prompt leaves
+    vllm_max_model_len: int
+    # Number of in-flight requests sent to vLLM; its continuous batching works best around 64-256
+    llm_concurrency: int
+    # Per-pass token budget in 512-token sequences (batch_size * 512 padded tokens); None picks one from the device
+    bge_batch_size: int | None
+    bge_compile: bool
+    # Persist embeddings keyed by content hash so unchanged texts are not re-embedded on later runs
+    bge_emb_cache: bool
+    tei_batch_size: int
+    # Insert the corpus in slices of this many documents while it is still being parsed; 0 inserts it in one go.
+    # Every insert recomputes event relationships over the whole graph, so small values add up on big corpora.
+    insert_batch_size: int
+
+def load_config() -> ExampleConfig:
+    print("🔧 Checking configuration...")
+    vllm_base_url = get_config_value(
+        "VLLM_BASE_URL", 
+        "Base URL for VLLM API service", 
+        "http://127.0.0.1:8000/v1"
+    )
+    best_model_name = get_config_value(
+        "QWEN_BEST", 
+        "Model name for the best/primary LLM", 
+        "qwen-14b"
+    )
+
+    bge_backend = os.getenv("BGE_BACKEND", "local")
+    local_bge_path = emb_url = None
+    if bge_backend == "tei":
+        emb_url = get_config_value(
+            "EMB_URL",
+            "Base URL for the text-embeddings-inference service",
+            "http://127.0.0.1:8080"
+        ).rstrip("/")
+    else:
+        local_bge_path = get_config_value(
+            "LOCAL_BGE_PATH", 
+            "Local path to BGE embedding model", 
+            "/path/to/bge-m3"
+        )
+
+    bge_batch_size = os.getenv("BGE_BATCH_SIZE")
+    return ExampleConfig(
+        vllm_base_url=vllm_base_url,
+        best_model_name=best_model_name,
+        bge_backend=bge_backend,
+        local_bge_path=local_bge_path,
+        emb_url=emb_url,
+        vllm_tokenizer_path=os.getenv("VLLM_TOKENIZER_PATH"),
+        vllm_max_model_len=int(os.getenv("VLLM_MAX_MODEL_LEN", 32768)),
+        llm_concurrency=int(os.getenv("LLM_CONCURRENCY", 128)),
+        bge_batch_size=int(bge_batch_size) if bge_batch_size else None,
+        bge_compile=os.getenv("BGE_COMPILE") == "1",
+        bge_emb_cache=os.getenv("BGE_EMB_CACHE", "1") != "0",
+        tei_batch_size=int(os.getenv("TEI_BATCH_SIZE", 32)),
+        insert_batch_size=int(os.getenv("INSERT_BATCH_SIZE", 0)),
+    )
+
+CONFIG = load_config()
 
 OPENAI_API_KEY_FAKE = "EMPTY"
 
+# Embeddings are produced as one contiguous (N, D) float16 array; normalized BGE vectors lose no
+# meaningful recall at half precision. This halves the worker IPC and on-disk cache payloads only:
+# the vector stores upcast on upsert (float32 in NanoVectorDB, float64 once timestamps are stacked on)
+EMBEDDING_DTYPE = np.float16
+
+class EmbeddingCache:
+    """SQLite-backed text -> float16 vector cache, shared by every embedding backend."""
+
+    def __init__(self, file_name: Path):
+        self._conn = sqlite3.connect(file_name)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model_id: str, text: str) -> str:
+        return xxhash.xxh3_128_hexdigest(f"{model_id}\0{text}".encode())
+
+    def get_many(self, keys: List[str]) -> dict[str, np.ndarray]:
+        hits = {}
+        # Stay below SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            hits.update((k, np.frombuffer(v, dtype=np.float16)) for k, v in rows)
+        return hits
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            [(k, v.astype(np.float16).tobytes()) for k, v in zip(keys, vectors)],
+        )
+        self._conn.commit()
+
+global_embedding_cache = None
+
+def get_embedding_cache_instance() -> EmbeddingCache | None:
+    global global_embedding_cache
+    if global_embedding_cache is None and CONFIG.bge_emb_cache:
+        global_embedding_cache = EmbeddingCache(WORK_DIR / "emb_cache.sqlite")
+    return global_embedding_cache
+
+async def embed_with_cache(texts: List[str], model_id: str, embedding_dim: int, embed) -> np.ndarray:
+    """Serve cached vectors and send only the misses to `embed`."""
+    cache = get_embedding_cache_instance()
+    if cache is None:
+        return await embed(texts)
+    keys = [cache.key(model_id, t) for t in texts]
+    hits = cache.get_many(keys)
+    out = np.empty((len(texts), embedding_dim), dtype=EMBEDDING_DTYPE)
+    miss_idx = []
+    for i, k in enumerate(keys):
+        if k in hits:
+            out[i] = hits[k]
+        else:
+            miss_idx.append(i)
+    if miss_idx:
+        miss_embeddings = await embed([texts[i] for i in miss_idx])
+        out[miss_idx] = miss_embeddings
+        cache.put_many([keys[i] for i in miss_idx], miss_embeddings)
+    return out
+
+def length_bucket_batches(lengths: np.ndarray, batch_size: int) -> List[np.ndarray]:
+    """Group indices into power-of-two length buckets, each batch holding up to batch_size * 512 padded tokens."""
+    token_budget = batch_size * 512
+    order = np.argsort(lengths, kind="stable")
+    buckets = np.maximum(128, 2 ** np.ceil(np.log2(np.maximum(lengths[order], 1)))).astype(int)
+    batches = []
+    for bucket in np.unique(buckets):
+        bucket_idx = order[buckets == bucket]
+        step = max(1, token_budget // int(bucket))
+        batches.extend(bucket_idx[i : i + step] for i in range(0, len(bucket_idx), step))
+    return batches
+
 @dataclass
-class EmbeddingFunc:
+class SentenceTransformerEncoder:
     embedding_dim: int
     max_token_size: int
     model: SentenceTransformer
+    batch_size: int = 64
+    model_id: str = ""
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Tokenize with the fast tokenizer and run the modules directly, skipping SentenceTransformer.encode."""
+        device = self.model.device
+        tokenizer = self.model.tokenizer
+        # Tokenize everything once; the real lengths drive bucketing and the ids are padded per batch
+        encoded = tokenizer(texts, truncation=True, max_length=self.max_token_size)
+        lengths = np.array([len(ids) for ids in encoded["input_ids"]])
+        out = np.empty((len(texts), self.embedding_dim), dtype=EMBEDDING_DTYPE)
+        batches = length_bucket_batches(lengths, self.batch_size)
+        using_cuda = device.type == "cuda"
+        # Host->device copies go on their own stream so they overlap with the forward pass
+        copy_stream = torch.cuda.Stream(device) if using_cuda else None
+
+        def prepare(idx: np.ndarray) -> dict:
+            features = tokenizer.pad(
+                {k: [encoded[k][i] for i in idx] for k in encoded.keys()},
+                padding=True,
+                return_tensors="pt",
+            )
+            if not using_cuda:
+                return features
+            with torch.cuda.stream(copy_stream):
+                return {k: v.pin_memory().to(device, non_blocking=True) for k, v in features.items()}
+
+        next_features = prepare(batches[0]) if batches else None
+        for i, idx in enumerate(batches):
+            features = next_features
+            if using_cuda:
+                compute_stream = torch.cuda.current_stream(device)
+                compute_stream.wait_stream(copy_stream)
+                for v in features.values():
+                    v.record_stream(compute_stream)
+            with torch.inference_mode():
+                # Runs transformer -> pooling (CLS for bge-m3) as configured in the checkpoint
+                emb = self.model(features)["sentence_embedding"]
+                # Normalize in fp32, then copy back at half precision
+                emb = F.normalize(emb.float(), p=2, dim=1).to(torch.float16)
+            # The kernels above are only queued; pad and upload the next batch while they run
+            if i + 1 < len(batches):
+                next_features = prepare(batches[i + 1])
+            out[idx] = emb.cpu().numpy()
+        return out
+
+def _default_bge_batch_size(using_cuda: bool) -> int:
+    """Pick the encode batch size, overridable through BGE_BATCH_SIZE.
+
+    It is a token budget expressed in 512-token sequences: every forward pass holds up to batch_size * 512
+    padded tokens, so short buckets run more sequences per pass (1024 sequences of <=128 tokens at 256).
+    """
+    if CONFIG.bge_batch_size:
+        return CONFIG.bge_batch_size
+    if not using_cuda:
+        return 64
+    # Smaller cards cannot hold 256 long bge-m3 sequences at once
+    total_memory = torch.cuda.get_device_properties(0).total_memory
+    return 256 if total_memory >= 16 * 1024**3 else 128
+
+def load_sentence_transformer_encoder() -> SentenceTransformerEncoder:
+    from sentence_transformers import SentenceTransformer
 
-    async def __call__(self, texts: List[str]) -> np.ndarray:
-        if isinstance(texts, str):
-            texts = [texts]
-        loop = asyncio.get_event_loop()
-        encode = lambda: self.model.encode(
-            texts,
-            batch_size=32,  # Smaller batch size to help with memory issues
-            convert_to_numpy=True,
-            show_progress_bar=False,
-            normalize_embeddings=True
-        )
-        if loop.is_running():
-            return await loop.run_in_executor(None, encode)
-        else:
-            return encode()
-    
-    # Make the model not serializable for GraphRAG initialization
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        state['model'] = None
-        return state
-    
-    # Restore model reference during deserialization (will be None, but structure preserved)
-    def __setstate__(self, state):
-        self.__dict__.update(state)
-
-def get_bge_embedding_func() -> EmbeddingFunc:
     gpu_count = torch.cuda.device_count()
     using_cuda = gpu_count > 0
     device = "cuda" if using_cuda else "cpu"
 
     model_kwargs = {}
+    if using_cuda:
+        # Half precision halves memory traffic and runs on tensor cores
+        model_kwargs = {"torch_dtype": torch.float16}
     if gpu_count > 1:
-        model_kwargs = {"device_map": "auto", "torch_dtype": torch.float16}
+        model_kwargs["device_map"] = "auto"
 
     st_model = SentenceTransformer(
-        LOCAL_BGE_PATH,
+        CONFIG.local_bge_path,
         device=device,              
         trust_remote_code=True,
         model_kwargs=model_kwargs,
     )
+    st_model.eval()
 
-    return EmbeddingFunc(
+    # Opt-in since the first batches pay for compilation
+    if using_cuda and CONFIG.bge_compile:
+        st_model[0].auto_model = torch.compile(
+            st_model[0].auto_model, dynamic=True, fullgraph=False
+        )
+
+    return SentenceTransformerEncoder(
         embedding_dim=st_model.get_sentence_embedding_dimension(),
         max_token_size=8192,        # bge-m3 supports long context
         model=st_model,
+        batch_size=_default_bge_batch_size(using_cuda),
+        model_id=CONFIG.local_bge_path,
+    )
+
+@dataclass
+class OnnxEncoder:
+    embedding_dim: int
+    max_token_size: int
+    model: ORTModelForFeatureExtraction
+    tokenizer: PreTrainedTokenizerFast
+    pooling: str = "cls"
+    batch_size: int = 64
+    model_id: str = ""
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_token_size)
+        lengths = np.array([len(ids) for ids in encoded["input_ids"]])
+        out = np.empty((len(texts), self.embedding_dim), dtype=EMBEDDING_DTYPE)
+        for idx in length_bucket_batches(lengths, self.batch_size):
+            features = self.tokenizer.pad(
+                {k: [encoded[k][i] for i in idx] for k in encoded.keys()},
+                padding=True,
+                return_tensors="np",
+            )
+            hidden = self.model(**features).last_hidden_state
+            if self.pooling == "cls":
+                emb = hidden[:, 0]
+            else:
+                mask = features["attention_mask"][..., None].astype(hidden.dtype)
+                emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            out[idx] = emb / np.linalg.norm(emb, axis=1, keepdims=True)
+        return out
+
+def load_onnx_encoder() -> OnnxEncoder:
+    """Export BGE to ONNX once (INT8-quantized for CPU) and run it through ONNX Runtime."""
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from transformers import AutoTokenizer
+
+    using_cuda = (
+        torch.cuda.is_available()
+        and "CUDAExecutionProvider" in onnxruntime.get_available_providers()
+    )
+    provider = "CUDAExecutionProvider" if using_cuda else "CPUExecutionProvider"
+
+    # One export per source checkpoint, so switching LOCAL_BGE_PATH never reuses another model's graph
+    onnx_dir = WORK_DIR / f"bge_onnx_{xxhash.xxh3_64_hexdigest(os.path.abspath(CONFIG.local_bge_path))}"
+    if not (onnx_dir / "model.onnx").exists():
+        logger.info(f"Exporting {CONFIG.local_bge_path} to ONNX in {onnx_dir}")
+        ORTModelForFeatureExtraction.from_pretrained(CONFIG.local_bge_path, export=True).save_pretrained(onnx_dir)
+        AutoTokenizer.from_pretrained(CONFIG.local_bge_path).save_pretrained(onnx_dir)
+
+    # Dynamic INT8 quantization targets CPU (VNNI); on CUDA the fp32 graph is faster
+    file_name = "model.onnx"
+    if not using_cuda:
+        file_name = "model_quantized.onnx"
+        if not (onnx_dir / file_name).exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logger.info(f"Quantizing ONNX BGE model to INT8 in {onnx_dir}")
+            quantize_dynamic(
+                onnx_dir / "model.onnx",
+                onnx_dir / file_name,
+                weight_type=QuantType.QInt8,
+                use_external_data_format=True,  # bge-m3 is larger than protobuf's 2GB limit
+            )
+
+    ort_model = ORTModelForFeatureExtraction.from_pretrained(onnx_dir, file_name=file_name, provider=provider)
+
+    # Follow the sentence-transformers pooling config shipped with the checkpoint (CLS for bge-m3)
+    pooling = "cls"
+    pooling_config = Path(CONFIG.local_bge_path) / "1_Pooling" / "config.json"
+    if pooling_config.exists():
+        with pooling_config.open(encoding="utf-8") as f:
+            pooling = "cls" if json.load(f).get("pooling_mode_cls_token") else "mean"
+
+    return OnnxEncoder(
+        embedding_dim=ort_model.config.hidden_size,
+        max_token_size=8192,
+        model=ort_model,
+        tokenizer=AutoTokenizer.from_pretrained(onnx_dir),
+        pooling=pooling,
+        batch_size=_default_bge_batch_size(using_cuda),
+        model_id=f"{CONFIG.local_bge_path}:{file_name}",
+    )
+
+def _embedding_worker_main(request_queue, response_queue):
+    """Entry point of the process that owns the BGE model; answers (req_id, texts) requests until it gets None."""
+    encoder = load_onnx_encoder() if CONFIG.bge_backend == "onnx" else load_sentence_transformer_encoder()
+    response_queue.put(("ready", encoder.embedding_dim, encoder.model_id))
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        req_id, texts = request
+        try:
+            emb = encoder.encode(texts)
+            response_queue.put((req_id, emb.tobytes(), emb.shape))
+        except Exception as e:
+            response_queue.put((req_id, None, f"{type(e).__name__}: {e}"))
+
+class EmbeddingWorker:
+    """Client side of the embedding process: sends requests and resolves one asyncio future per request."""
+
+    def __init__(self):
+        # spawn, not fork: the child sets up its own CUDA context and never inherits the parent's
+        ctx = mp.get_context("spawn")
+        self._request_queue = ctx.Queue()
+        self._response_queue = ctx.Queue()
+        self._process = ctx.Process(
+            target=_embedding_worker_main,
+            args=(self._request_queue, self._response_queue),
+            daemon=True,
+        )
+        self._process.start()
+        self._pending: dict[int, tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self._next_id = itertools.count()
+        self._lock = threading.Lock()
+        # Set once the process is gone; later encode() calls raise it instead of waiting on a dead queue
+        self._dead: RuntimeError | None = None
+
+        while True:
+            try:
+                _, self.embedding_dim, self.model_id = self._response_queue.get(timeout=5)
+                break
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(f"Embedding worker exited with code {self._process.exitcode} while loading the model")
+
+        # mp.Queue.get blocks, so responses are read on a thread and handed back to each caller's loop
+        threading.Thread(target=self._read_responses, daemon=True).start()
+        atexit.register(self.close)
+
+    def _read_responses(self):
+        while True:
+            try:
+                req_id, payload, info = self._response_queue.get(timeout=1)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+                self._fail_pending(RuntimeError(f"Embedding worker exited with code {self._process.exitcode}"))
+                return
+            except (EOFError, OSError) as e:
+                self._fail_pending(RuntimeError(f"Embedding worker connection lost: {type(e).__name__}: {e}"))
+                return
+            with self._lock:
+                loop, fut = self._pending.pop(req_id)
+            if payload is None:
+                loop.call_soon_threadsafe(_set_future_exception, fut, RuntimeError(f"Embedding worker failed: {info}"))
+            else:
+                emb = np.frombuffer(payload, dtype=EMBEDDING_DTYPE).reshape(info)
+                loop.call_soon_threadsafe(_set_future_result, fut, emb)
+
+    def _fail_pending(self, exc: RuntimeError):
+        with self._lock:
+            self._dead = exc
+            pending, self._pending = self._pending, {}
+        for loop, fut in pending.values():
+            loop.call_soon_threadsafe(_set_future_exception, fut, exc)
+
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._lock:
+            # Checked under the lock, so a request either fails here or is failed by _fail_pending
+            if self._dead is None and not self._process.is_alive():
+                self._dead = RuntimeError(f"Embedding worker exited with code {self._process.exitcode}")
+            if self._dead is not None:
+                raise self._dead
+            req_id = next(self._next_id)
+            self._pending[req_id] = (loop, fut)
+        self._request_queue.put((req_id, texts))
+        return await fut
+
+    def close(self):
+        with self._lock:
+            if self._dead is None:
+                self._dead = RuntimeError("Embedding worker is closed")
+        if self._process.is_alive():
+            self._request_queue.put(None)
+            self._process.join(timeout=10)
+
+def _set_future_result(fut: asyncio.Future, result):
+    if not fut.done():
+        fut.set_result(result)
+
+def _set_future_exception(fut: asyncio.Future, exc: Exception):
+    if not fut.done():
+        fut.set_exception(exc)
+
+global_embedding_worker = None
+
+def get_embedding_worker_instance() -> EmbeddingWorker:
+    global global_embedding_worker
+    if global_embedding_worker is None:
+        global_embedding_worker = EmbeddingWorker()
+    return global_embedding_worker
+
+@dataclass
+class EmbeddingFunc:
+    """Embedding function handed to GraphRAG; holds plain config only, the model lives in the worker process."""
+    embedding_dim: int
+    max_token_size: int
+    model_id: str = ""
+
+    async def __call__(self, texts: List[str]) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        return await embed_with_cache(
+            texts, self.model_id, self.embedding_dim, get_embedding_worker_instance().encode
+        )
+
+def get_bge_embedding_func() -> EmbeddingFunc:
+    worker = get_embedding_worker_instance()
+    return EmbeddingFunc(
+        embedding_dim=worker.embedding_dim,
+        max_token_size=8192,        # bge-m3 supports long context
+        model_id=worker.model_id,
+    )
+
+global_tei_async_client = None
+
+def get_tei_async_client_instance() -> httpx.AsyncClient:
+    global global_tei_async_client
+    if global_tei_async_client is None:
+        global_tei_async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=512, max_keepalive_connections=512),
+            timeout=httpx.Timeout(600, connect=10),
+        )
+    return global_tei_async_client
+
+@dataclass
+class TEIEmbeddingFunc:
+    embedding_dim: int
+    max_token_size: int
+    base_url: str
+    # TEI rejects requests larger than its --max-client-batch-size (32 by default)
+    client_batch_size: int = 32
+
+    async def __call__(self, texts: List[str]) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        return await embed_with_cache(texts, self.base_url, self.embedding_dim, self._embed_all)
+
+    async def _embed_all(self, texts: List[str]) -> np.ndarray:
+        out = np.empty((len(texts), self.embedding_dim), dtype=EMBEDDING_DTYPE)
+
+        async def embed_slice(start: int):
+            end = start + self.client_batch_size
+            out[start:end] = await self._embed(texts[start:end])
+
+        # Send every slice at once and let TEI's dynamic batching merge them
+        await asyncio.gather(
+            *[embed_slice(i) for i in range(0, len(texts), self.client_batch_size)]
+        )
+        return out
+
+    async def _embed(self, texts: List[str]) -> np.ndarray:
+        client = get_tei_async_client_instance()
+        response = await client.post(
+            f"{self.base_url}/embed",
+            json={"inputs": texts, "normalize": True, "truncate": True},
+        )
+        response.raise_for_status()
+        return np.asarray(response.json(), dtype=np.float32)
+
+def get_tei_embedding_func() -> TEIEmbeddingFunc:
+    # Probe once to learn the dimension of the served model
+    response = httpx.post(f"{CONFIG.emb_url}/embed", json={"inputs": ["dimension probe"]}, timeout=60)
+    response.raise_for_status()
+    return TEIEmbeddingFunc(
+        embedding_dim=len(response.json()[0]),
+        max_token_size=8192,
+        base_url=CONFIG.emb_url,
+        client_batch_size=CONFIG.tei_batch_size,
     )
     
 ################################################################################
 # 2. LLM call function (with cache)
 ################################################################################
 
-def _build_async_client() -> AsyncOpenAI:
-    return AsyncOpenAI(api_key=OPENAI_API_KEY_FAKE, base_url=VLLM_BASE_URL)
+global_vllm_async_client = None
+
+def get_vllm_async_client_instance() -> AsyncOpenAI:
+    """Share one client (and its keep-alive connection pool) across all LLM calls."""
+    global global_vllm_async_client
+    if global_vllm_async_client is None:
+        global_vllm_async_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY_FAKE,
+            base_url=CONFIG.vllm_base_url,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=512, max_keepalive_connections=512),
+                timeout=httpx.Timeout(600, connect=10),
+            ),
+        )
+    return global_vllm_async_client
+
+_llm_sem = asyncio.Semaphore(CONFIG.llm_concurrency)
+
+@functools.lru_cache(maxsize=1)
+def _get_vllm_tokenizer():
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(CONFIG.vllm_tokenizer_path)
+
+def _chat_prompt_token_ids(messages: list[dict[str, str]]) -> list[int]:
+    # One tokenizer for every call; the example only talks to QWEN_BEST
+    return _get_vllm_tokenizer().apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+
+# Chat-only parameters that AsyncCompletions.create does not accept; vLLM reads them from the request body
+_CHAT_ONLY_KWARGS = ("response_format",)
 
 async def _chat_completion(model: str, messages: list[dict[str, str]], **kwargs) -> str:
-    client = _build_async_client()
-    response = await client.chat.completions.create(model=model, messages=messages, **kwargs)
+    client = get_vllm_async_client_instance()
+    if CONFIG.vllm_tokenizer_path:
+        # The chat endpoint only takes text, so send pre-tokenized prompts to /v1/completions
+        # Rendering and tokenizing a 16k-token prompt takes milliseconds; keep it off the event loop
+        prompt_token_ids = await asyncio.to_thread(_chat_prompt_token_ids, messages)
+        kwargs.setdefault("max_tokens", max(1, CONFIG.vllm_max_model_len - len(prompt_token_ids)))
+        extra_body = dict(kwargs.pop("extra_body", None) or {})
+        for name in _CHAT_ONLY_KWARGS:
+            if name in kwargs:
+                extra_body[name] = kwargs.pop(name)
+        if extra_body:
+            kwargs["extra_body"] = extra_body
+        async with _llm_sem:
+            response = await client.completions.create(model=model, prompt=prompt_token_ids, **kwargs)
+        return response.choices[0].text
+    async with _llm_sem:
+        response = await client.chat.completions.create(model=model, messages=messages, **kwargs)
     return response.choices[0].message.content
 
+# The KV store is only persisted every N new answers; GraphRAG flushes it again when insert/query finishes
+_KV_FLUSH_EVERY = 64
+_kv_pending_writes = 0
+
 async def _llm_with_cache(
     prompt: str,
     *,
@@ -161,6 +667,7 @@ async def _llm_with_cache(
     msgs.extend(history_messages)
     msgs.append({"role": "user", "content": prompt})
 
+    global _kv_pending_writes
     if hashing_kv is not None:
         args_hash = compute_args_hash(model, msgs)
         cached = await hashing_kv.get_by_id(args_hash)
@@ -171,51 +678,84 @@ async def _llm_with_cache(
 
     if hashing_kv is not None:
         await hashing_kv.upsert({args_hash: {"return": answer, "model": model}})
-        await hashing_kv.index_done_callback()
+        _kv_pending_writes += 1
+        if _kv_pending_writes >= _KV_FLUSH_EVERY:
+            _kv_pending_writes = 0
+            await hashing_kv.index_done_callback()
     return answer
 
 async def best_model_func(prompt: str, system_prompt: str | None = None, history_messages: list[dict[str,str]] | None = None, **kwargs) -> str:
     return await _llm_with_cache(
         prompt,
-        model=BEST_MODEL_NAME,
+        model=CONFIG.best_model_name,
         system_prompt=system_prompt,
         history_messages=history_messages,
         **kwargs,
     )
 
-embedding_func = get_bge_embedding_func()
-model_ref = embedding_func.model
-embedding_func.model = None 
-
-def read_json_file(fp: Path):
-    with fp.open(encoding="utf-8") as f:
-        return json.load(f)
-
-graph_func = GraphRAG(
-    working_dir=str(WORK_DIR),
-    embedding_func=embedding_func,
-    best_model_func=best_model_func,
-    cheap_model_func=best_model_func,
-    enable_llm_cache=True,
-    best_model_max_token_size = 16384,
-    cheap_model_max_token_size = 16384,
-    model_path="./models",  
-    ce_model="cross-encoder/ms-marco-TinyBERT-L-2-v2",  
-    ner_model_name="dslim_bert_base_ner", 
-)
-
-embedding_func.model = model_ref
-
-corpus_data = read_json_file(CORPUS_FILE)
-total_docs = len(corpus_data)
-logger.info(f"Start processing, total {total_docs} documents to process.")
-
-all_docs = []
-for idx, obj in enumerate(tqdm(corpus_data, desc="Loading docs", total=total_docs)):
-    # Combine metadata with content
-    enriched_content = f"Title: {obj['title']}\nDocument ID: {obj['doc_id']}\n\n{obj['context']}"
-    all_docs.append(enriched_content)
- 
-graph_func.insert(all_docs)
-
-print(graph_func.query("Where was Barbara Hammer educated after Mar 1962?", param=QueryParam(mode="dynamic")))
+
+def iter_json_items(fp: Path):
+    """Yield the items of a top-level JSON array without decoding the whole file up front."""
+    try:
+        import ijson
+    except ImportError:
+        # orjson still reads the whole file, but decodes it several times faster than json
+        logger.info(f"ijson is not installed, loading all of {fp} before inserting; pip install ijson to stream it")
+        yield from orjson.loads(fp.read_bytes())
+        return
+    with fp.open("rb") as f:
+        yield from ijson.items(f, "item")
+
+def build_graph_func() -> GraphRAG:
+    if CONFIG.bge_backend == "tei":
+        embedding_func = get_tei_embedding_func()
+    else:
+        embedding_func = get_bge_embedding_func()
+
+    graph_func = GraphRAG(
+        working_dir=str(WORK_DIR),
+        embedding_func=embedding_func,
+        # Hand the encoder large slices; it splits them into token-budgeted forward passes itself
+        embedding_batch_num=1024,
+        best_model_func=best_model_func,
+        cheap_model_func=best_model_func,
+        # GraphRAG caps concurrent LLM calls itself; keep that in line with the semaphore above
+        best_model_max_async=CONFIG.llm_concurrency,
+        cheap_model_max_async=CONFIG.llm_concurrency,
+        enable_llm_cache=True,
+        best_model_max_token_size = 16384,
+        cheap_model_max_token_size = 16384,
+        model_path="./models",  
+        ce_model="cross-encoder/ms-marco-TinyBERT-L-2-v2",  
+        ner_model_name="dslim_bert_base_ner", 
+    )
+    return graph_func
+
+async def insert_docs(graph_func: GraphRAG, docs: List[str]):
+    if not docs:
+        logger.warning("No documents to insert")
+        return
+    logger.info(f"Start processing, inserting {len(docs)} documents.")
+    await graph_func.ainsert(docs)
+
+_doc_fields = operator.itemgetter("title", "doc_id", "context")
+
+def enrich_doc(obj: dict) -> str:
+    """Combine metadata with content (doc_id is an int in the corpus, so %-format rather than join)."""
+    return "Title: %s\nDocument ID: %s\n\n%s" % _doc_fields(obj)
+
+async def main():
+    graph_func = build_graph_func()
+
+    # Lazy: items are parsed and formatted only as each insert slice is taken
+    docs = map(enrich_doc, iter_json_items(CORPUS_FILE))
+    if not CONFIG.insert_batch_size:
+        await insert_docs(graph_func, list(docs))
+    else:
+        while batch := list(itertools.islice(docs, CONFIG.insert_batch_size)):
+            await insert_docs(graph_func, batch)
+
+    print(await graph_func.aquery("Where was Barbara Hammer educated after Mar 1962?", param=QueryParam(mode="dynamic")))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,6 @@
 import re
 import json
 import asyncio
-import tiktoken
 import datetime
 import time
 from dateutil import parser as date_parser
@@ -28,6 +27,7 @@ from ._utils import (
     compute_args_hash,
     decode_tokens_by_tiktoken,
     encode_string_by_tiktoken,
+    get_tiktoken_encoder,
     is_float_regex,
     list_of_list_to_csv,
     pack_user_ass_to_openai_messages,
@@ -399,7 +399,7 @@ def get_chunks(new_docs, chunk_func=chunking_by_token_size, **chunk_func_params)
         doc_titles.append(title)
 
     # Use OpenAI's tokenizer - seems to work well enough
-    ENCODER = tiktoken.get_encoding("cl100k_base")
+    ENCODER = get_tiktoken_encoder()
     tokens = ENCODER.encode_batch(docs, num_threads=16)  # TODO: make threads configurable
     
     chunks = chunk_func(
@@ -11,7 +11,9 @@ from hashlib import md5
 from typing import Any, Union
 
 import numpy as np
+import orjson
 import tiktoken
+import xxhash
 
 logger = logging.getLogger("DyG-RAG")
 ENCODER = None
@@ -115,20 +117,22 @@ def convert_response_to_json(response: str) -> dict:
     return prediction_json
 
 
-# New functions using cl100k_base encoding
-def encode_string_by_tiktoken(content: str, model_name: str = "gpt-4o"):
+def get_tiktoken_encoder() -> tiktoken.Encoding:
+    """Load the cl100k_base encoding on first use and reuse it afterwards."""
     global ENCODER
     if ENCODER is None:
         ENCODER = tiktoken.get_encoding("cl100k_base")
-    tokens = ENCODER.encode(content)
+    return ENCODER
+
+
+# New functions using cl100k_base encoding
+def encode_string_by_tiktoken(content: str, model_name: str = "gpt-4o"):
+    tokens = get_tiktoken_encoder().encode(content)
     return tokens
 
 
 def decode_tokens_by_tiktoken(tokens: list[int], model_name: str = "gpt-4o"):
-    global ENCODER
-    if ENCODER is None:
-        ENCODER = tiktoken.get_encoding("cl100k_base")
-    content = ENCODER.decode(tokens)
+    content = get_tiktoken_encoder().decode(tokens)
     return content
 
 
@@ -187,7 +191,8 @@ def is_float_regex(value):
 
 
 def compute_args_hash(*args):
-    return md5(str(args).encode()).hexdigest()
+    """Cache key for LLM calls; not cryptographic, so a fast non-crypto hash is enough."""
+    return xxhash.xxh3_128_hexdigest(orjson.dumps(args))
 
 
 def split_string_by_multi_markers(content: str, markers: list[str]) -> list[str]:
@@ -911,7 +911,7 @@ class GraphRAG:
                 return
             
             torch.cuda.empty_cache()
-            time.sleep(2)
+            await asyncio.sleep(2)
            
             # ---------- commit upsertings
             await self.full_docs.upsert(new_docs)